@@ -14,14 +14,89 @@ import re
 import sys
 import time
 import json
+import hashlib
+import contextvars
+from collections import OrderedDict
 from typing import Optional, Union
 from pydantic import BaseModel, Field
 from open_webui.main import generate_chat_completion  # type: ignore
 from open_webui.models.users import UserModel  # type: ignore
 from open_webui.models.chats import Chats  # type: ignore
 
+try:  # Optional: offline language detection, LLM fallback when missing
+    from langdetect import DetectorFactory, detect_langs  # type: ignore
+    from langdetect.detector_factory import init_factory  # type: ignore
+
+    DetectorFactory.seed = 0
+    init_factory()  # Load the profiles once here, not on the first request
+except ImportError:
+    detect_langs = None
+
 version = "0.2.7"
 
+# ISO 639-1 code -> common names (English, native, Italian) and ISO 639-2 codes,
+# checked before the LLM
+LANG_ALIASES = {
+    "ar": "arabic arabo العربية ara",
+    "bg": "bulgarian bulgaro български bul",
+    "ca": "catalan catala catalano català cat",
+    "cs": "czech cestina ceco čeština ces cze",
+    "da": "danish dansk danese dan",
+    "de": "german deutsch tedesco deu ger",
+    "el": "greek greco ελληνικά ell gre",
+    "en": "english inglese eng",
+    "es": "spanish espanol castellano spagnolo español spa",
+    "et": "estonian eesti est",
+    "fa": "persian farsi persiano فارسی fas per",
+    "fi": "finnish suomi finlandese fin",
+    "fr": "french francais francese français fra fre",
+    "ga": "irish gaeilge gle",
+    "he": "hebrew ebraico עברית heb",
+    "hi": "hindi हिन्दी hin",
+    "hr": "croatian hrvatski croato hrv",
+    "hu": "hungarian magyar ungherese hun",
+    "id": "indonesian indonesiano ind",
+    "it": "italian italiano ita",
+    "ja": "japanese nihongo giapponese 日本語 jpn",
+    "ko": "korean coreano 한국어 kor",
+    "la": "latin latino lat",
+    "lt": "lithuanian lietuvių lit",
+    "lv": "latvian latviešu lav",
+    "ms": "malay melayu msa may",
+    "nl": "dutch nederlands olandese nld dut",
+    "no": "norwegian norsk norvegese nor",
+    "pl": "polish polski polacco pol",
+    "pt": "portuguese portugues portoghese português por",
+    "ro": "romanian romana rumeno română ron rum",
+    "ru": "russian russkiy russo русский rus",
+    "sk": "slovak slovenčina slk slo",
+    "sl": "slovenian slovenščina slv",
+    "sr": "serbian српски srpski srp",
+    "sv": "swedish svenska svedese swe",
+    "th": "thai ไทย tha",
+    "tr": "turkish turkce turco türkçe tur",
+    "uk": "ukrainian ucraino українська ukr",
+    "ur": "urdu اردو urd",
+    "vi": "vietnamese vietnamita vie",
+    "zh": "chinese mandarin cinese zhongwen 中文 汉语 普通话 zho chi",
+}
+LANG_NAMES = {n: iso for iso, names in LANG_ALIASES.items() for n in names.split()}
+# ISO 639-1 codes: anything else is a typo or a word, not a language code
+ISO_CODES = frozenset(
+    (
+        "aa ab ae af ak am an ar as av ay az ba be bg bh bi bm bn bo br bs ca ce "
+        "ch co cr cs cu cv cy da de dv dz ee el en eo es et eu fa ff fi fj fo fr "
+        "fy ga gd gl gn gu gv ha he hi ho hr ht hu hy hz ia id ie ig ii ik io is "
+        "it iu ja jv ka kg ki kj kk kl km kn ko kr ks ku kv kw ky la lb lg li ln "
+        "lo lt lu lv mg mh mi mk ml mn mr ms mt my na nb nd ne ng nl nn no nr nv "
+        "ny oc oj om or os pa pi pl ps pt qu rm rn ro ru rw sa sc sd se sg si sk "
+        "sl sm sn so sq sr ss st su sv sw ta te tg th ti tk tl tn to tr ts tt tw "
+        "ty ug uk ur uz ve vi vo wa wo xh yi yo za zh zu"
+    ).split()
+)
+
+_request_ctx = contextvars.ContextVar("easylang_ctx")
+
 
 class Filter:
     class Valves(BaseModel):
@@ -34,19 +109,121 @@ class Filter:
         back_translation: bool = Field(
             default=False, description="Translate assistant response back."
         )
+        speculative: bool = Field(
+            default=False,
+            description="Start translating to TL while the language is detected (extra call when wrong).",
+        )
+        single_pass: bool = Field(
+            default=False,
+            description="Detect and translate in one LLM call (model must follow JSON).",
+        )
+        local_detection: bool = Field(
+            default=True,
+            description="Detect the language offline when possible, LLM otherwise.",
+        )
+        skip_same_language: bool = Field(
+            default=False,
+            description="Return same-language TR text as-is instead of refining it.",
+        )
+        split_long_texts: bool = Field(
+            default=False,
+            description="Translate long TR texts in parallel chunks (less shared context).",
+        )
         debug: bool = Field(
             default=False, description="Enable detailed state dumps in logs."
         )
 
+    # Compiled once at import, shared by every Filter instance
+    RE_ISO = re.compile(r"\b([a-z]{2})\b", re.I)
+    RE_NAME_WORD = re.compile(r"\w+")
+    RE_SCRUB = re.compile(r"<think>.*?</think>|</?text>", re.S)
+    LANG_CACHE_SIZE = 128
+    QUERY_CACHE_SIZE = 512
+    STATE_CACHE_SIZE = 1024
+    PENDING_SIZE = 256
+    USER_CACHE_SIZE = 256
+    # split_long_texts: paragraphs packed into chunks of about this size
+    SPLIT_CHUNK_CHARS = 1500
+    SPLIT_CONCURRENCY = 4
+    # langdetect is confidently wrong on short snippets ("ciao mondo" -> pt)
+    LOCAL_DETECT_MIN_CHARS = 30
+    LOCAL_DETECT_MIN_PROB = 0.9
+    # Scripts used by one language only (Han and Cyrillic are ambiguous)
+    SCRIPT_LANGS = (
+        (0x3040, 0x30FF, "ja"),  # Hiragana, Katakana
+        (0xAC00, 0xD7AF, "ko"),  # Hangul syllables
+        (0x0370, 0x03FF, "el"),
+        (0x0590, 0x05FF, "he"),
+        (0x0E00, 0x0E7F, "th"),
+        (0x10A0, 0x10FF, "ka"),
+        (0x0530, 0x058F, "hy"),
+    )
+    # English function words that no other Latin-script language uses as such
+    EN_MARKERS = frozenset(
+        "the and you are what with this that have your how don't i'm it's".split()
+    )
+    RE_WORD = re.compile(r"[a-z']+")
+    # Static detection prompt: only the text sample is appended per call
+    DETECT_PROMPT = "Detect language of this text (ISO 639-1 code only, ignore names): "
+    DETECT_INSTRUCTION = "Respond with the 2-letter ISO code ONLY."
+    # Output cap for calls that answer with an ISO code
+    SHORT_ANSWER_TOKENS = 8
+    # Fixed sampling options shared by every internal sub-call
+    QUERY_DEFAULTS = {"stream": False, "seed": 42, "temperature": 0.0}
+    # Commands answered by the filter itself: the main model emits one token
+    SUPPRESS_PROMPT = "MANDATORY:No talk. Just respond with this exact emoji: 🌐"
+    SUPPRESS_OPTIONS = {
+        "temperature": 0.0,
+        "num_predict": 1,
+        "max_tokens": 1,
+        "stream": False,
+        "think": False,
+        "seed": 42,
+    }
+
     def __init__(self):
         self.valves = self.Valves()
-        self.ctx = {}
-        self.RE_HELP = re.compile(r"^t\?$", re.I)
-        self.RE_CONFIG = re.compile(r"^(TL|BL)(?:\:(.+))?\s*$", re.I)
-        self.RE_TRANS = re.compile(
-            r"^(TRS|TRC|TR)(?:\:([a-z]{2,10}))?(?:\s+(.*))?$", re.I | re.S
-        )
-        self.RE_ISO = re.compile(r"\b([a-z]{2})\b", re.I)
+        self._pending = OrderedDict()
+        self._lang_cache = OrderedDict()
+        self._query_cache = OrderedDict()
+        self._inflight = {}
+        self._state_cache = OrderedDict()
+        self._user_cache = OrderedDict()
+        self._dirty = {}
+        self._flushes = {}
+
+    @property
+    def ctx(self) -> dict:
+        """
+        Per-request context. Backed by a ContextVar so concurrent requests
+        from different users or chats never see each other's state.
+        """
+        return _request_ctx.get({})
+
+    @ctx.setter
+    def ctx(self, value: dict):
+        _request_ctx.set(value)
+
+    def _ctx_key(self, body: dict, user: Optional[dict]) -> tuple:
+        uid = (user or {}).get("id", "default")
+        cid = body.get("chat_id") or (body.get("metadata") or {}).get("chat_id")
+        # Clients without chat metadata get a per-user slot, not a shared one
+        return uid, cid or f"anon-{uid}"
+
+    def _user_model(self, user: dict) -> UserModel:
+        """
+        Reuses the validated UserModel while the user's data is unchanged.
+        """
+        uid = user.get("id", "default")
+        cached = self._user_cache.get(uid)
+        if cached and cached[0] == user:
+            self._user_cache.move_to_end(uid)
+            return cached[1]
+        model = UserModel(**user)
+        self._user_cache[uid] = (dict(user), model)
+        if len(self._user_cache) > self.USER_CACHE_SIZE:
+            self._user_cache.popitem(last=False)
+        return model
 
     async def inlet(
         self,
@@ -57,8 +234,7 @@ class Filter:
     ) -> dict:
 
         messages = body.get("messages", [])
-        cid = body["metadata"]["chat_id"]
-        if not messages or not __user__ or not cid:
+        if not messages or not __user__:
             return body
 
         # FIX: Multimodal Text Extraction (v0.2.6)
@@ -70,28 +246,39 @@ class Filter:
         content = content.strip()
 
         cmd = ""
+        key = uid, cid = self._ctx_key(body, __user__)
+        self._pending.pop(key, None)  # Any new message supersedes a pending command
         ctx = self.ctx = {}
         dbg_str = ""
 
-        if self.RE_HELP.match(content):
+        # Every command starts with one of these heads: ordinary chat skips parsing
+        head = content[:2].upper()
+        if head not in ("T?", "TL", "BL", "TR"):
+            return body
+
+        # Fixed-shape commands: "t?", "TL"/"BL" alone or "TL:<lang>" on one line
+        if head == "T?" and len(content) == 2:
             cmd = "HELP"
-        elif match := self.RE_CONFIG.match(content):
-            cmd, lang = (
-                match.group(1).upper(),
-                (match.group(2).strip() if match.group(2) else None),
-            )
+        elif head in ("TL", "BL") and (
+            len(content) == 2
+            or (content[2] == ":" and len(content) > 3 and "\n" not in content)
+        ):
+            cmd, lang = head, content[3:].strip() or None
             ctx["lang"] = lang
             dbg_str = f"Config command detected: {cmd} with parameter: {lang}"
-        elif match := self.RE_TRANS.match(content):
-            cmd = match.group(1).upper()
-            lang = match.group(2) if match.group(2) else None
-            text = match.group(3).strip() if match.group(3) else ""
+        elif parsed := self._parse_trans(content):
+            cmd, lang, text = parsed
             ctx["lang"] = lang
             ctx["text"] = text
             dbg_str = f"Translation command: {cmd} | Language Param: {lang} | Text Length: {len(text)}"
         else:
             return body
 
+        # Outlet runs in another task: hand the context over by (user, chat)
+        self._pending[key] = ctx
+        if len(self._pending) > self.PENDING_SIZE:
+            self._pending.popitem(last=False)
+
         # self._dmp(body, "INLET RAW BODY")
 
         bm = body.get("model", "")
@@ -104,9 +291,9 @@ class Filter:
                 "bm": bm,
                 "tm": tm,
                 "req": __request__,
-                "user": UserModel(**__user__),
+                "user": self._user_model(__user__),
                 "emitter": __event_emitter__,
-                "uid": __user__.get("id", "default"),
+                "uid": uid,
                 "cmd": cmd,
             }
         )
@@ -114,7 +301,7 @@ class Filter:
         self._dbg(
             f"\n\n 👉 --- INLET START | Chat ID: {ctx['cid']} | Command: {cmd} ---\n"
         )
-        self._dbg(f"{dbg_str}")
+        self._dbg(dbg_str)
         await self._get_state()
         self._dbg(f"Current Memory State -> Base: {ctx['bl']} | Target: {ctx['tl']}")
 
@@ -124,9 +311,15 @@ class Filter:
             lang = ctx.get("lang")
             lang_key = cmd.lower()
             if lang:
-                new_lang = lang.strip().lower()
+                # Config commands never call the LLM: offline resolution only
+                new_lang = self._iso_local(lang)
                 curr_lang = ctx.get(lang_key)
-                if new_lang != curr_lang:
+                if not new_lang:
+                    ctx["msg"] = (
+                        f"⚠️ Unknown language **{lang}**: {cmd} stays **{curr_lang}**. "
+                        f"Use an ISO 639-1 code (e.g. `{cmd.lower()}:fr`)."
+                    )
+                elif new_lang != curr_lang:
                     ctx[lang_key] = new_lang
                     await self._set_state()
                     ctx["msg"] = (
@@ -146,15 +339,19 @@ class Filter:
             translated_text, target_lang = await self._run_translation_task(
                 text, ctx["lang"], cmd
             )
+            if not target_lang:  # Unknown trc:<lang>, shown by the outlet
+                ctx["cmd"] = "WARN"
+                return self._suppress_output(body)
 
             # Inject into prompt
             body["messages"][-1] = {
                 "role": "user",
                 "content": f"Respond in language (ISO 639-1 code):{target_lang.upper()}:\n{translated_text}",
             }
-            self._dbg(
-                f"\n\nTRC: Injected direct task. Target: {target_lang}. Prompt: {translated_text}\n"
-            )
+            if self.valves.debug:  # Avoid copying the whole prompt when off
+                self._dbg(
+                    f"\n\nTRC: Injected direct task. Target: {target_lang}. Prompt: {translated_text}\n"
+                )
             await self._status("Waiting for assistant response..")
             return body
 
@@ -175,11 +372,13 @@ class Filter:
         __request__=None,
         __event_emitter__=None,
     ) -> dict:
-        assistant_msg = body["messages"][-1]
-        ctx = self.ctx
-        cmd = ctx.get("cmd")
-        if not cmd:
+        messages = body.get("messages")
+        ctx = self._pending.pop(self._ctx_key(body, __user__), None)
+        if not ctx or not messages:
             return body
+        self.ctx = ctx
+        cmd = ctx.get("cmd")
+        assistant_msg = messages[-1]
 
         # self._dmp(body, "OUTLET RAW BODY")
 
@@ -192,19 +391,21 @@ class Filter:
         # --- Outlet-Centric Logic ---
         if cmd in ("TR", "TRS"):
             # FIX: Pass the body messages to resolve text from the valid history
-            text = await self._resolve_text(body.get("messages"), cmd)
+            text = await self._resolve_text(messages, cmd)
 
             if text:
                 translated_text, target_lang = await self._run_translation_task(
                     text, ctx["lang"], cmd
                 )
 
-                ctx["msg"] = translated_text
-                assistant_msg["content"] = translated_text
-
-                target_actual = target_lang.upper()
-                base_lang = ctx.get("bl", "it").upper()
-                info = ctx.get("current_direction", f"{base_lang} ➔ {target_actual}")
+                if target_lang:
+                    ctx["msg"] = translated_text
+                    target_actual = target_lang.upper()
+                    base_lang = ctx.get("bl", "it").upper()
+                    info = ctx.get(
+                        "current_direction", f"{base_lang} ➔ {target_actual}"
+                    )
+                assistant_msg["content"] = ctx["msg"]
             else:
                 assistant_msg["content"] = (
                     "Error: Could not retrieve text to translate."
@@ -215,13 +416,13 @@ class Filter:
             info = f"{base_lang} ➔ {target_actual} ➔ {base_lang}"
             content = assistant_msg.get("content", "")
             if content:
-                await self._status(
-                    f"Back-translating from {target_actual} to {base_lang}"
-                )
                 instruction = (
                     f"RULE: Translate the following text to language (ISO 639-1): {base_lang}. "
                     "RULE: Preserve formatting and tone. Respond ONLY with the translation."
                 )
+                await self._status(
+                    f"Back-translating from {target_actual} to {base_lang}"
+                )
                 translated = await self._query(content, instruction)
                 if translated:
                     assistant_msg["content"] = translated
@@ -230,7 +431,7 @@ class Filter:
         elif cmd == "TRC":
             pass
 
-        elif cmd in ("HELP", "TL", "BL"):
+        elif cmd in ("HELP", "TL", "BL", "WARN"):
             if cmd in ("TL", "BL"):
                 info = f"{base_lang} ➔ {target_actual}"
             assistant_msg["content"] = ctx.get("msg", "Something went wrong")
@@ -239,6 +440,23 @@ class Filter:
         self._dmp(ctx["tl"], "EasyLang Context")
         return body
 
+    def _parse_trans(self, content: str) -> Optional[tuple]:
+        """
+        Parses `<cmd>[:<lang>] [text]` for TR/TRS/TRC with plain string ops.
+        Returns (cmd, lang, text), or None if content is not a translation command.
+        """
+        parts = content.split(None, 1)
+        if not parts:
+            return None
+        cmd, sep, lang = parts[0].partition(":")
+        cmd = cmd.upper()
+        if cmd not in ("TR", "TRS", "TRC"):
+            return None
+        if sep and not (2 <= len(lang) <= 10 and lang.isascii() and lang.isalpha()):
+            return None
+        text = parts[1].strip() if len(parts) > 1 else ""
+        return cmd, (lang or None), text
+
     async def _resolve_text(self, messages: Optional[list], cmd: str) -> str:
         """
         Robust text retrieval strategy.
@@ -253,7 +471,9 @@ class Filter:
 
         if messages:
             # self._dmp(messages, "CONTEXT RETRIEVAL - BODY SCAN")
-            for m in reversed(messages[:-1]):
+            # Index walk: skips the current message without copying the list
+            for i in range(len(messages) - 2, -1, -1):
+                m = messages[i]
                 if m.get("role") == "assistant" and m.get("content"):
                     cand = m.get("content", "").strip()
                     # Skip artifacts
@@ -275,27 +495,71 @@ class Filter:
         Shared by Inlet (TRC) and Outlet (TR/TRS).
         """
         ctx = self.ctx
-
-        # 1. Robust Language Detection
-        await self._status("Detecting language...")
-        text_lang = await self._query(
-            f"Detect language of this text (ISO 639-1 code only, ignore names): {text[:100]}",
-            "Respond with the 2-letter ISO code ONLY.",
-        )
-        text_lang = text_lang.lower().strip()[:2]
+        override = await self._to_iso(lang_param) if lang_param else ""
+        if lang_param and not override:
+            # Explicit target not understood: report it, don't guess another one
+            ctx["msg"] = (
+                f"⚠️ Unknown language **{lang_param}**: nothing was translated. "
+                f"Use an ISO 639-1 code (e.g. `{cmd.lower()}:fr`)."
+            )
+            return "", ""
+        translated_text = ""
+        spec, spec_target, spec_status = None, "", ""
+
+        # 1. Robust Language Detection (cached per model and text sample)
+        sample = text[:100]
+        cache_key = (ctx.get("tm", ""), sample)
+        text_lang = self._lang_cache.get(cache_key)
+        if text_lang:
+            self._lang_cache.move_to_end(cache_key)
+            self._dbg(f"Language cache hit: {text_lang}")
+        else:
+            if self.valves.local_detection:
+                text_lang = await self._detect_local(text)
+            if text_lang:
+                self._dbg(f"Language detected locally: {text_lang}")
+            elif self.valves.single_pass and cmd != "TRS":
+                text_lang, translated_text = await self._detect_and_translate(
+                    text, override
+                )
+            if not text_lang and self.valves.speculative:
+                # Target is TL (or override) unless the text is already in it
+                spec_target = override or ctx.get("tl", "en")
+                payload, instruction, spec_status = self._build_task(
+                    cmd, text, "", spec_target
+                )
+                spec = asyncio.create_task(self._query(payload, instruction))
+            if not text_lang:
+                await self._status("Detecting language...")
+                text_lang = await self._query(
+                    self.DETECT_PROMPT + sample,
+                    self.DETECT_INSTRUCTION,
+                    self.SHORT_ANSWER_TOKENS,
+                )
+            # Whole answer must be a code: "The language is Italian" is not "th"
+            text_lang = text_lang.strip(" .`'\"").lower()
+            if text_lang not in ISO_CODES:
+                # Cut-off or chatty reply: unknown, never cached nor anchored
+                self._dbg(f"Detection answer unusable: {text_lang!r}")
+                text_lang = ""
+            else:
+                self._lang_cache[cache_key] = text_lang
+                if len(self._lang_cache) > self.LANG_CACHE_SIZE:
+                    self._lang_cache.popitem(last=False)
 
         # 2. State Preparation
-        bl = str(ctx.get("bl", "en")).lower()
-        tl = str(ctx.get("tl", "en")).lower()
+        bl = ctx.get("bl", "en")
+        tl = ctx.get("tl", "en")
         self._dbg(f"Logic State -> Input: {text_lang} | BL: {bl} | TL: {tl}")
 
         # 3. Target Selection Logic
         old_bl, old_tl = bl, tl
-        if lang_param:
-            target_lang = await self._to_iso(lang_param)
-            tl = target_lang
-            if text_lang != tl:
+        if override:
+            target_lang = tl = override
+            if text_lang and text_lang != tl:
                 bl = text_lang
+        elif not text_lang:
+            target_lang = tl  # Unknown source: translate to TL, keep the anchors
         elif text_lang == bl:
             target_lang = tl
         elif text_lang == tl:
@@ -317,63 +581,221 @@ class Filter:
             self._dbg(f"Safety Swap triggered: New target is {target_lang}")
 
         ctx["target_actual"] = target_lang
-        ctx["current_direction"] = f"{text_lang.upper()} ➔ {target_lang.upper()}"
+        ctx["current_direction"] = (
+            f"{(text_lang or 'auto').upper()} ➔ {target_lang.upper()}"
+        )
+
+        # 5. Execution
+        if translated_text:
+            self._dbg("Single-pass translation reused, skipping second call.")
+        elif spec and spec_target == target_lang:
+            self._dbg("Speculative translation matched the target, reusing it.")
+            await self._status(spec_status)
+            translated_text = await spec
+        else:
+            if spec:
+                spec.cancel()
+                self._dbg(f"Speculative target {spec_target} discarded.")
+            if target_lang == text_lang and (
+                cmd == "TRC" or (cmd == "TR" and self.valves.skip_same_language)
+            ):
+                # Nothing to translate: TRC sends the prompt as-is. For TR this
+                # would drop the refine pass, so it is opt-in.
+                self._dbg("Source matches target, skipping translation call.")
+                translated_text = text
+            elif (
+                self.valves.split_long_texts
+                and cmd == "TR"
+                and len(text) > 2 * self.SPLIT_CHUNK_CHARS
+                and "\n\n" in text
+                and "```" not in text  # Never cut a fenced code block in half
+                and "~~~" not in text
+            ):
+                translated_text = await self._translate_paragraphs(
+                    text, text_lang, target_lang
+                )
+            else:
+                query_payload, instruction, status_msg = self._build_task(
+                    cmd, text, text_lang, target_lang
+                )
+                await self._status(status_msg)
+                translated_text = await self._query(query_payload, instruction)
 
-        # 5. Execution & Instruction Setup
-        instruction = ""
-        status_msg = ""
-        query_payload = ""
-        tm = ctx.get("tm", "")
+        return translated_text, target_lang
+
+    async def _translate_paragraphs(self, text: str, text_lang: str, target_lang: str):
+        """
+        Long TR texts: neighbouring paragraphs are packed into chunks of about
+        SPLIT_CHUNK_CHARS, translated concurrently and joined back with the
+        original breaks. Any failed chunk fails the whole translation.
+        """
+        chunks = [""]
+        for part in text.split("\n\n"):
+            if chunks[-1] and len(chunks[-1]) + len(part) > self.SPLIT_CHUNK_CHARS:
+                chunks.append(part)
+            else:
+                chunks[-1] = f"{chunks[-1]}\n\n{part}" if chunks[-1] else part
+        sem = asyncio.Semaphore(self.SPLIT_CONCURRENCY)
+
+        async def translate(chunk: str) -> str:
+            payload, instruction, _ = self._build_task(
+                "TR", chunk, text_lang, target_lang
+            )
+            async with sem:
+                return await self._query(payload, instruction)
+
+        await self._status(
+            f"Translating {len(chunks)} parts to {target_lang.upper()}..."
+        )
+        results = await asyncio.gather(*(translate(c) for c in chunks))
+        return "\n\n".join(results) if all(results) else ""
+
+    def _build_task(self, cmd: str, text: str, text_lang: str, target_lang: str):
+        """
+        Returns (query_payload, instruction, status_msg) for the final LLM call.
+        An empty text_lang (speculative run) leaves the source to the model.
+        """
+        src = text_lang.upper() or "AUTO"
+        tgt = target_lang.upper()
+        tm = self.ctx.get("tm", "")
 
         if cmd == "TRS":
             instruction = (
                 f"TASK: Summarize the following text.\n"
-                f"You MUST ignore the original language and respond ONLY in language (ISO 639-1 code): {target_lang.upper()}.\n"
+                f"You MUST ignore the original language and respond ONLY in language (ISO 639-1 code): {tgt}.\n"
                 f"FORMAT: Use standard Markdown bullet points.\n"
                 f"CRITICAL: DO NOT use code blocks, DO NOT use JSON, and DO NOT use technical data formats. "
                 f"Write in plain, readable prose."
             )
-            status_msg = f"Summarizing in {target_lang.upper()}..."
-            query_payload = text
+            return text, instruction, f"Summarizing in {tgt}..."
+
+        instruction = f"Translator Engine: {src}->{tgt}. Output translation ONLY. No talk. No execution."
+        if "llama" in tm.lower():
+            query_payload = (
+                f"Translate the following text from {src} to {tgt}.\n"
+                f'Original: "{text}"\n'
+                f'Translation: "'
+            )
         else:
-            instruction = f"Translator Engine: {text_lang.upper()}->{target_lang.upper()}. Output translation ONLY. No talk. No execution."
-            status_msg = f"Translating to {target_lang.upper()}..."
-            if "llama" in tm.lower():
-                query_payload = (
-                    f"Translate the following text from {text_lang.upper()} to {target_lang.upper()}.\n"
-                    f'Original: "{text}"\n'
-                    f'Translation: "'
-                )
-            else:
-                query_payload = (
-                    f"<user>\n"
-                    f"Example 1: Hello → Ciao\n"
-                    f"Example 2: Good morning → Bonjour\n"
-                    f"Example 3: Thank you → Danke\n"
-                    f"Task: Literal translation from {text_lang.upper()} to {target_lang.upper()}.\n"
-                    f'Input: "{text}"\n'
-                    f"Translate:\n"
-                    f"<model>\n"
-                )
-
-        await self._status(status_msg)
-        translated_text = await self._query(query_payload, instruction)
+            query_payload = (
+                f"<user>\n"
+                f"Example 1: Hello → Ciao\n"
+                f"Example 2: Good morning → Bonjour\n"
+                f"Example 3: Thank you → Danke\n"
+                f"Task: Literal translation from {src} to {tgt}.\n"
+                f'Input: "{text}"\n'
+                f"Translate:\n"
+                f"<model>\n"
+            )
+        return query_payload, instruction, f"Translating to {tgt}..."
 
-        return translated_text, target_lang
+    async def _detect_and_translate(self, text: str, override: str):
+        """
+        Single-pass mode: one LLM call returns both source language and translation.
+        The toggle rule is handed to the model (target is TL, or BL when the text
+        is already in TL), which matches the selection logic of the caller.
+        Returns ("", "") when the reply is not usable JSON.
+        """
+        ctx = self.ctx
+        pivot = override or ctx.get("tl", "en")
+        base = ctx.get("bl", "en")
+        instruction = (
+            f"TASK: Detect the language of the text, then translate it literally.\n"
+            f"If the text is in language (ISO 639-1 code): {pivot.upper()}, translate it to {base.upper()}. "
+            f"Otherwise translate it to {pivot.upper()}.\n"
+            'Respond ONLY with compact JSON: {"src":"<ISO 639-1 code of the text>","out":"<translation>"}'
+        )
+        await self._status("Detecting language and translating...")
+        raw = await self._query(text, instruction)
+        try:
+            data = json.loads(raw[raw.index("{") : raw.rindex("}") + 1])
+            src = str(data["src"]).strip(" .`'\"").lower()
+            out = str(data["out"]).strip()
+        except (ValueError, KeyError, TypeError) as e:
+            self._dbg(f"Single-pass reply unusable, falling back: {e}")
+            return "", ""
+        if not (src in ISO_CODES and out):
+            return "", ""
+        return src, out
+
+    async def _detect_local(self, text: str) -> str:
+        """
+        Offline detection: single-language scripts first, then the optional
+        `langdetect` package. Returns "" when unavailable, the text is too short
+        or the guess is weak, so the caller falls back to the LLM.
+        """
+        sample = text[:200]
+        letters = [c for c in sample if c.isalpha()]
+        foreign = [ord(c) for c in letters if not c.isascii()]
+        if len(foreign) * 2 > len(letters):
+            # A script decides only when it holds most of the non-ASCII letters:
+            # a stray "α" in Cyrillic or Chinese text must not make it Greek
+            counts = {}
+            for lo, hi, lang in self.SCRIPT_LANGS:
+                counts[lang] = sum(lo <= o <= hi for o in foreign)
+            han = sum(0x4E00 <= o <= 0x9FFF for o in foreign)
+            if counts["ja"] * 5 >= han:  # Enough kana: the kanji are Japanese
+                counts["ja"] += han
+            lang = max(counts, key=counts.get)
+            if counts[lang] * 2 > len(foreign):
+                return lang
+        if len(sample) < self.LOCAL_DETECT_MIN_CHARS:
+            # Too little for statistics: only unmistakable English passes, i.e.
+            # two distinct markers that also make up a large share of the words
+            if sample.isascii():
+                words = self.RE_WORD.findall(sample.lower())
+                hits = [w for w in words if w in self.EN_MARKERS]
+                if len(set(hits)) >= 2 and len(hits) * 5 >= len(words) * 2:
+                    return "en"
+            return ""
+        if detect_langs is None:
+            return ""
+        try:
+            # Pure Python, a few ms per call: keep it off the event loop
+            best = (await asyncio.to_thread(detect_langs, sample))[0]
+        except Exception as e:
+            self._dbg(f"Local detection failed: {e}")
+            return ""
+        if best.prob < self.LOCAL_DETECT_MIN_PROB:
+            return ""
+        return best.lang[:2]
 
     async def _status(self, description: str, done: bool = False):
-        emitter = self.ctx.get("emitter")
+        """
+        Intermediate updates are sent by a background task that only keeps the
+        latest one, so a burst costs one emit and never delays an LLM call.
+        The final (done) update supersedes anything still queued.
+        """
+        ctx = self.ctx
+        emitter = ctx.get("emitter")
         if not emitter:
             return
-        await emitter(  # type: ignore
-            {
-                "type": "status",
-                "data": {
-                    "description": description,
-                    "done": done,
-                },
-            }
-        )
+        event = {
+            "type": "status",
+            "data": {
+                "description": description,
+                "done": done,
+            },
+        }
+        if not done:
+            ctx["status_next"] = event
+            if not ctx.get("status_task"):
+                ctx["status_task"] = asyncio.create_task(
+                    self._drain_status(ctx, emitter)
+                )
+            return
+        ctx.pop("status_next", None)
+        task = ctx.get("status_task")
+        if task:
+            await asyncio.gather(task, return_exceptions=True)
+        await emitter(event)  # type: ignore
+
+    async def _drain_status(self, ctx: dict, emitter):
+        try:
+            while event := ctx.pop("status_next", None):
+                await emitter(event)
+        finally:
+            ctx["status_task"] = None
 
     def _service_msg(self) -> str:
         bl = self.ctx.get("bl")
@@ -400,73 +822,159 @@ class Filter:
         """
         try:
             ctx = self.ctx
+            cached = self._state_cache.get(ctx["cid"])
+            if cached:
+                self._state_cache.move_to_end(ctx["cid"])
+                ctx["bl"], ctx["tl"] = cached
+                self._dbg(f"State loaded from memory: {cached[0]} -> {cached[1]}")
+                return
             self._dbg(f"Attempting to load state for Chat ID: {ctx['cid']}")
-            chat_obj = Chats.get_chat_by_id(ctx["cid"])
+            chat_obj = await asyncio.to_thread(Chats.get_chat_by_id, ctx["cid"])
             if chat_obj:
                 raw = chat_obj.chat
                 content = raw.get("chat", raw) if isinstance(raw, dict) else raw
                 meta = content.get("meta", {}) if isinstance(content, dict) else {}
+                # Stored codes are canonicalized once here, compared as-is later
                 if meta.get("bl"):
-                    ctx["bl"] = meta["bl"]
+                    ctx["bl"] = str(meta["bl"]).strip().lower()
                     self._dbg(f"BL loaded from DB: {meta['bl']}")
                 if meta.get("tl"):
-                    ctx["tl"] = meta["tl"]
+                    ctx["tl"] = str(meta["tl"]).strip().lower()
                     self._dbg(f"TL loaded from DB: {meta['tl']}")
             if not ctx.get("bl"):
                 ctx["bl"] = "en"
             if not ctx.get("tl"):
                 ctx["tl"] = "en"
+            self._remember_state()
         except Exception as e:
             self._dbg(f"Metadata not found or DB error: {e}")
             self.ctx.update({"bl": "en", "tl": "en"})
 
     async def _set_state(self):
         """
-        Saves BL and TL to the DB (chat column -> meta).
+        Updates BL and TL in memory and schedules the DB write as a deferred task.
+        Bursts on the same chat coalesce: only the latest state gets written.
+        """
+        ctx = self.ctx
+        cid = ctx["cid"]
+        self._remember_state()
+        self._dirty[cid] = (ctx["bl"], ctx["tl"])
+        if cid not in self._flushes:
+            self._flushes[cid] = asyncio.create_task(self._flush_state(cid))
+
+    async def _flush_state(self, cid: str):
+        """
+        Deferred write of the latest state. The read-modify-write stays on the
+        event loop: Open WebUI writes the same chat row from coroutines, and a
+        worker thread could overwrite a message saved in between with stale history.
         """
         try:
-            ctx = self.ctx
-            self._dbg(f"Attempting to save state for Chat ID: {ctx['cid']}")
-            chat_obj = Chats.get_chat_by_id(ctx["cid"])
-            if not chat_obj:
-                self._dbg(f"Save failed: Chat object not found for ID {ctx['cid']}")
-                return
-            raw = chat_obj.chat
-            content = raw.get("chat", raw) if isinstance(raw, dict) else raw
-            if not isinstance(content, dict):
-                content = {"messages": [], "meta": {}}
-            if "meta" not in content:
-                content["meta"] = {}
-            content["meta"]["bl"] = ctx["bl"]
-            content["meta"]["tl"] = ctx["tl"]
-            Chats.update_chat_by_id(ctx["cid"], {"chat": content})
-            self._dbg(f"💾 State saved successfully: {ctx['bl']} -> {ctx['tl']}")
+            bl, tl = self._dirty.pop(cid)
+            self._write_state(cid, bl, tl)
         except Exception as e:
             self._err(f"Save error: {e}")
+        finally:
+            del self._flushes[cid]
 
-    async def _to_iso(self, lang) -> str:
-        await self._status(f"Identifying target language: {lang}")
+    def _write_state(self, cid: str, bl: str, tl: str):
+        """
+        Saves BL and TL to the DB (chat column -> meta).
+        """
+        self._dbg(f"Attempting to save state for Chat ID: {cid}")
+        chat_obj = Chats.get_chat_by_id(cid)
+        if not chat_obj:
+            self._dbg(f"Save failed: Chat object not found for ID {cid}")
+            return
+        raw = chat_obj.chat
+        content = raw.get("chat", raw) if isinstance(raw, dict) else raw
+        if not isinstance(content, dict):
+            content = {"messages": [], "meta": {}}
+        if "meta" not in content:
+            content["meta"] = {}
+        content["meta"]["bl"] = bl
+        content["meta"]["tl"] = tl
+        Chats.update_chat_by_id(cid, {"chat": content})
+        self._dbg(f"💾 State saved successfully: {bl} -> {tl}")
+
+    def _remember_state(self):
+        """
+        Write-through memory copy of BL/TL, so warm chats skip the DB read.
+        """
+        ctx = self.ctx
+        self._state_cache[ctx["cid"]] = (ctx["bl"], ctx["tl"])
+        self._state_cache.move_to_end(ctx["cid"])
+        if len(self._state_cache) > self.STATE_CACHE_SIZE:
+            self._state_cache.popitem(last=False)
+
+    def _iso_local(self, lang: str) -> str:
+        """
+        Offline resolution only: ISO code, known name or a code inside the text.
+        Returns "" when unresolved.
+        """
         clean_lang = lang.strip().lower()
-        if len(clean_lang) == 2 and clean_lang.isalpha():
+        if clean_lang in ISO_CODES:
             return clean_lang
-        match = self.RE_ISO.search(clean_lang)
-        if match:
-            return match.group(1)
+        if clean_lang in LANG_NAMES:
+            return LANG_NAMES[clean_lang]
+        # Names win over bare codes: "english (uk)" is en, not Ukrainian
+        for word in self.RE_NAME_WORD.findall(clean_lang):
+            if word in LANG_NAMES:
+                return LANG_NAMES[word]
+        for code in self.RE_ISO.findall(clean_lang):
+            if code in ISO_CODES:
+                return code
+        return ""
+
+    async def _to_iso(self, lang) -> str:
+        iso_lang = self._iso_local(lang)
+        if iso_lang:
+            return iso_lang
         self._dbg(
             f"Language '{lang}' not recognized locally. Querying LLM for ISO conversion..."
         )
+        await self._status(f"Identifying target language: {lang}")
         iso_lang = await self._query(
-            f"lang:{lang}", "Respond immediately. ISO 639-1 code ONLY."
+            f"lang:{lang}",
+            "Respond immediately. ISO 639-1 code ONLY.",
+            self.SHORT_ANSWER_TOKENS,
         )
-        return iso_lang
+        # Only a bare code is trusted (and stored): chatty replies count as unresolved
+        iso_lang = iso_lang.strip(" .`'").lower()
+        return iso_lang if iso_lang in ISO_CODES else ""
 
-    async def _query(self, prompt: str, instruct: str = "") -> str:
+    async def _query(self, prompt: str, instruct: str = "", max_tokens: int = 0) -> str:
+
+        if not prompt or prompt.isspace():
+            return ""
 
         ctx = self.ctx
         req = ctx.get("req")
         selected_model = ctx.get("tm")
         user = ctx.get("user")
 
+        # Sub-calls are deterministic (temperature 0, fixed seed): reuse answers.
+        # Keyed by digest so the cache doesn't pin every full prompt in memory.
+        digest = hashlib.blake2b(f"{instruct}\0{prompt}".encode(), digest_size=16)
+        cache_key = (selected_model, digest.digest())
+        cached = self._query_cache.get(cache_key)
+        if cached is not None:
+            self._query_cache.move_to_end(cache_key)
+            self._dbg(f"Query cache hit for model: {selected_model}")
+            return cached
+
+        # Identical query already running (burst of equal commands): share it
+        flight = self._inflight.get(cache_key)
+        if flight:
+            self._dbg(f"Joining in-flight query for model: {selected_model}")
+            try:
+                return await asyncio.shield(flight)
+            except asyncio.CancelledError:
+                if not flight.cancelled():
+                    raise  # This caller was cancelled, not the shared query
+                # The owner was cancelled (e.g. a discarded speculative run): retry
+                return await self._query(prompt, instruct, max_tokens)
+        flight = self._inflight[cache_key] = asyncio.get_running_loop().create_future()
+
         # Create a fresh, isolated message list for the translator
         # This prevents loading the entire chat history
         isolated_messages = []
@@ -477,13 +985,17 @@ class Filter:
         isolated_messages.append({"role": "user", "content": prompt})
 
         payload = {
+            **self.QUERY_DEFAULTS,
             "model": selected_model,
             "messages": isolated_messages,
-            "stream": False,
-            "seed": 42,
-            "temperature": 0.0,
         }
+        if max_tokens:
+            # Short-answer call: cap generation and disable reasoning
+            payload.update(
+                {"max_tokens": max_tokens, "num_predict": max_tokens, "think": False}
+            )
 
+        content = ""
         try:
 
             self._dbg(
@@ -495,35 +1007,43 @@ class Filter:
             if response:
                 ctx["tk"] += response.get("usage", {}).get("total_tokens", 0)
 
-                content = response["choices"][0]["message"]["content"].strip()
-                content = re.sub(
-                    r"<think>.*?</think>", "", content, flags=re.DOTALL
-                ).strip()
-                content = re.sub(r"</?text>", "", content).strip()
-                return content.strip('"')
-
-            return ""
+                # Outer whitespace is trimmed once, after the tag removal
+                content = response["choices"][0]["message"]["content"]
+                if "<" in content:
+                    content = self.RE_SCRUB.sub("", content)
+                    # Reasoning cut off by the token cap: no answer follows it
+                    content = content.split("<think>", 1)[0]
+                content = content.strip().strip('"')
+                if content:
+                    self._query_cache[cache_key] = content
+                    if len(self._query_cache) > self.QUERY_CACHE_SIZE:
+                        self._query_cache.popitem(last=False)
+
+        except asyncio.CancelledError:
+            flight.cancel()  # Joiners retry instead of getting an empty answer
+            raise
 
         except Exception as e:
 
             self._err(e)
 
-            return ""
+        finally:
+            del self._inflight[cache_key]
+            if not flight.done():
+                flight.set_result(content)
+
+        return content
 
     def _dbg(self, message: str):
         if self.valves.debug:
-            print(f"⚡EASYLANG: {message}", file=sys.stderr, flush=True)
+            print(f"⚡EASYLANG: {message}", file=sys.stderr)
 
     def _dmp(self, data, title: Optional[str] = "data"):
         if self.valves.debug:
             header = "—" * 80 + "\n📦 EasyLang Dump\n" + "—" * 80
-            print(header, file=sys.stderr, flush=True)
-            print(
-                f"{title}: " + json.dumps(data, indent=4),
-                file=sys.stderr,
-                flush=True,
-            )
-            print("—" * 80, file=sys.stderr, flush=True)
+            print(header, file=sys.stderr)
+            print(f"{title}: " + json.dumps(data, indent=4), file=sys.stderr)
+            print("—" * 80, file=sys.stderr)
 
     def _err(self, e: Union[Exception, str]):
         err_msg = str(e)
@@ -547,6 +1067,9 @@ class Filter:
 
     async def _send_telemetry_status(self, assistant_msg: dict, info: str):
         ctx = self.ctx
+        # Nobody to show the status line to: skip the math and formatting
+        if not ctx.get("emitter") and not self.valves.debug:
+            return
         cmd = ctx.get("cmd")
         usage = assistant_msg.get("usage", {})
         raw_total_tk = usage.get("total_tokens", 0)
@@ -583,18 +1106,8 @@ class Filter:
         """
         self._dbg("Suppressing output and Wiping ephemeral history.")
 
-        body["messages"][:] = [
-            {
-                "role": "user",
-                "content": "MANDATORY:No talk. Just respond with this exact emoji: 🌐",
-            }
-        ]
-        body["temperature"] = 0.0
-        body["num_predict"] = 1
-        body["max_tokens"] = 1
-        body["stream"] = False
-        body["think"] = False
-        body["seed"] = 42
-        if "stop" in body:
-            del body["stop"]
+        # Fresh message dict: downstream code may annotate it in place
+        body["messages"][:] = [{"role": "user", "content": self.SUPPRESS_PROMPT}]
+        body.update(self.SUPPRESS_OPTIONS)
+        body.pop("stop", None)
         return body